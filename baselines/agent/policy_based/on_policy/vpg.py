@@ -1,10 +1,27 @@
 import numpy as np
 import torch, torch.nn.functional as F
 from torch.optim import Adam
+from torch.distributions import Normal
 from baselines.common.policy import OnPolicyAlgorithm
+from baselines.common.checkpoint import save_checkpoint, load_checkpoint
 from baselines.common.network import MLPGaussianPolicy, MLPGaussianSDEPolicy, MLPVFunction
 
 
+def bf16_autocast(device, enabled=True):
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=enabled and device.type == 'cuda')
+
+
+# When compiled, backward() is a graph break: this runs as a compiled forward, an eager
+# backward and a separately compiled optimizer step, not a single replayed CUDA graph.
+def _critic_step(critic, critic_optim, states, rets):
+    with bf16_autocast(states.device):
+        critic_loss = F.mse_loss(critic(states), rets)
+    critic_loss.backward()
+    critic_optim.step()
+    critic_optim.zero_grad(set_to_none=True)
+    return critic_loss.detach()
+
+
 class VPG(OnPolicyAlgorithm):
     def __init__(self, env, **config):
         super().__init__(
@@ -27,8 +44,18 @@ class VPG(OnPolicyAlgorithm):
 
         self.vf_iters = config.get('vf_iters', 10)
         self.gsde_mode = config.get('gsde_mode', False)
+        self.log_entropy = config.get('log_entropy', True)
+        self.compile_mode = config.get('compile', False) and self.device.type == 'cuda'
+        self.n_envs = config.get('n_envs', 1)
         self.config = config
 
+        if self.update_after % self.n_envs != 0:
+            raise ValueError('update_after must be a multiple of n_envs.')
+
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.set_float32_matmul_precision('high')
+
         if self.gsde_mode:
             self.actor = MLPGaussianSDEPolicy(
                 self.state_dim, 
@@ -52,20 +79,36 @@ class VPG(OnPolicyAlgorithm):
 
         self.actor_optim = Adam(self.actor.parameters(), lr=self.actor_lr)
         self.critic_optim = Adam(self.critic.parameters(), lr=self.critic_lr)
+        self._compile()
+
+        if self.device.type == 'cuda':
+            self._state_buf = torch.empty(self.state_dim, pin_memory=True)
+            self._state_gpu = torch.empty(self.state_dim, device=self.device)
 
     @torch.no_grad()
     def act(self, state, training=True, global_buffer_size=None):
         self.actor.train(training)
-        state = torch.FloatTensor(state).to(self.device)
-        mu, std = self.actor(state)
+        state = np.asarray(state)
+        if state.ndim == 1 and self.device.type == 'cuda':
+            self._state_buf.copy_(torch.from_numpy(state))
+            state = self._state_gpu.copy_(self._state_buf, non_blocking=True)
+        else:
+            # CPU, or an (n_envs, state_dim) batch, e.g. from gym.vector.AsyncVectorEnv
+            state = torch.as_tensor(state, dtype=torch.float32, device=self.device)
+        # deterministic (eval) actions skip bf16 so mu is not rounded
+        with bf16_autocast(self.device, enabled=training):
+            mu, std = self._actor_forward(state)
+        mu, std = mu.float(), std.float()
 
         if self.gsde_mode:
             dist = self.actor.dist(state)
             action = dist.sample() if training else mu
-            return torch.tanh(action + self.actor.get_noise()).cpu().numpy()
+            action = torch.tanh(action + self.actor.get_noise())
         else:
-            action = torch.normal(mu, std) if training else mu
-            return torch.tanh(action).cpu().numpy()
+            action = (mu + std * torch.randn_like(mu)) if training else mu
+            action = torch.tanh(action)
+
+        return action.cpu().numpy()
         
     def learn(self, states, actions, rewards, next_states, dones):
         self.actor.train()
@@ -75,44 +118,74 @@ class VPG(OnPolicyAlgorithm):
             self.actor.reset_noise()
             
         with torch.no_grad():
-            values, next_values = self.critic(states), self.critic(next_states)
+            values, next_values = self._critic_forward(torch.cat([states, next_states], dim=0)).chunk(2, dim=0)
             rets, advs = self.GAE(values, next_values, rewards, dones)
 
-        log_probs = self.actor.log_prob(states, actions)
+        if self.gsde_mode:
+            dist = self.actor.dist(states)
+        else:
+            with bf16_autocast(self.device):
+                mu, std = self._actor_forward(states)
+            dist = Normal(mu.float(), std.float())
+        log_probs = self.actor.dist_log_prob(dist, actions)
         actor_loss = -(log_probs * advs).mean()
 
-        self.actor_optim.zero_grad()
+        self.actor_optim.zero_grad(set_to_none=True)
         actor_loss.backward()
         self.actor_optim.step()
 
-        critic_losses = []
-        for _ in range(self.vf_iters):
-            critic_loss = F.mse_loss(self.critic(states), rets)
-            self.critic_optim.zero_grad()
-            critic_loss.backward()
-            self.critic_optim.step()
-            critic_losses.append(critic_loss.item())
+        critic_losses = torch.empty(self.vf_iters, device=self.device)
+        self.critic_optim.zero_grad(set_to_none=True)
+        for i in range(self.vf_iters):
+            critic_losses[i] = self._critic_step(self.critic, self.critic_optim, states, rets)
+
+        if self.log_entropy:
+            with torch.no_grad():
+                entropy = dist.entropy().mean()
+        else:
+            entropy = torch.tensor(0.0)
 
-        entropy = self.actor.entropy(states)
         result = {
             'agent_timesteps': self.timesteps, 
             'actor_loss': actor_loss.item(), 
-            'critic_loss': np.mean(critic_losses), 
+            'critic_loss': critic_losses.mean().item(), 
             'entropy': entropy.item()
             }
                 
         return result
     
+    def _compile(self):
+        if self.compile_mode:
+            self._actor_forward = torch.compile(self.actor, mode='reduce-overhead', dynamic=False)
+            self._critic_forward = torch.compile(self.critic, mode='reduce-overhead', dynamic=False)
+            self._critic_step = torch.compile(_critic_step, mode='reduce-overhead')
+        else:
+            self._actor_forward, self._critic_forward, self._critic_step = self.actor, self.critic, _critic_step
+
+    # compiled callables keep references to this agent's modules, so copies
+    # (deepcopy by the ray runners, pickled logs) fall back to eager calls; the trainer
+    # is dropped too, since it can hold a user env_fn (e.g. a lambda) that pickle rejects
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('_actor_forward', '_critic_forward', '_critic_step', 'trainer'):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._actor_forward, self._critic_forward, self._critic_step = self.actor, self.critic, _critic_step
+
     def save(self, save_path):
-        torch.save({
-            'actor_state_dict': self.actor.state_dict(),
-            'critic_state_dict': self.critic.state_dict(),
-            'actor_optim_state_dict': self.actor_optim.state_dict(),
-            'critic_optim_state_dict': self.critic_optim.state_dict()
-        }, save_path)
+        save_checkpoint(
+            save_path,
+            actor_state_dict=self.actor.state_dict(),
+            critic_state_dict=self.critic.state_dict(),
+            actor_optim_state_dict=self.actor_optim.state_dict(),
+            critic_optim_state_dict=self.critic_optim.state_dict()
+            )
 
     def load(self, load_path):
-        checkpoint = torch.load(load_path, weights_only=True)
+        checkpoint = load_checkpoint(load_path, device=self.device)
         self.actor.load_state_dict(checkpoint['actor_state_dict'])
         self.critic.load_state_dict(checkpoint['critic_state_dict'])
         self.actor_optim.load_state_dict(checkpoint['actor_optim_state_dict'])
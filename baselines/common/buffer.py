@@ -1,6 +1,8 @@
-import ray, torch, random, pickle, numpy as np
+import ray, torch, pickle, numpy as np
 from baselines.common.operation import MinSegmentTree, SumSegmentTree
 
+MIN_PRIO = 1e-6
+
 
 def combined_shape(length, shape=None):
     if shape is None:
@@ -82,11 +84,25 @@ class RolloutBuffer(BaseBuffer):
             )
 
     def sample(self):
-        states = torch.FloatTensor(self.states[:self.ptr]).to(self.device)
-        actions = torch.FloatTensor(self.actions[:self.ptr]).to(self.device)
-        rewards = torch.FloatTensor(self.rewards[:self.ptr]).to(self.device)
-        next_states = torch.FloatTensor(self.next_states[:self.ptr]).to(self.device)
-        dones = torch.FloatTensor(self.dones[:self.ptr]).to(self.device)
+        n = self.ptr
+        elements = (self.states, self.actions, self.rewards, self.next_states, self.dones)
+        if self._device_elements is None or len(self._device_elements[0]) < n:
+            self._device_elements = [torch.empty(x[:n].shape, device=self.device) for x in elements]
+            self._pinned_elements = None
+            if torch.device(self.device).type == 'cuda':
+                self._pinned_elements = [torch.empty(x[:n].shape, pin_memory=True) for x in elements]
+
+        if self._pinned_elements is None:
+            host_elements = [torch.from_numpy(x[:n]) for x in elements]
+        else:
+            host_elements = [pinned_x[:n] for pinned_x in self._pinned_elements]
+            for pinned_x, x in zip(host_elements, elements):
+                pinned_x.numpy()[:] = x[:n]
+
+        states, actions, rewards, next_states, dones = (
+            device_x[:n].copy_(host_x, non_blocking=True)
+            for device_x, host_x in zip(self._device_elements, host_elements)
+            )
 
         self.reset()
         if self.reward_norm:
@@ -94,6 +110,19 @@ class RolloutBuffer(BaseBuffer):
 
         return states, actions, rewards, next_states, dones
 
+    def reset(self):
+        if getattr(self, 'states', None) is None:
+            super().reset()
+            self._pinned_elements, self._device_elements = None, None
+        self.ptr, self.is_full = 0, False
+
+    # the pinned staging and the device copies are sized to the rollout and
+    # rebuilt lazily in sample(), so pickles (and ray deepcopies) only carry the arrays
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pinned_elements'], state['_device_elements'] = None, None
+        return state
+
 
 class ReplayBuffer(BaseBuffer):
     def __init__(self, state_dim, action_dim, buffer_size, batch_size, device, reward_norm=False, epsilon=1e-8):
@@ -164,30 +193,26 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         return states, actions, rewards, next_states, dones, weights, idxs
         
     def update_priorities(self, idxs, prios):
+        prios = np.maximum(prios, MIN_PRIO)
         for idx, prio in zip(idxs, prios):
             self.sum_tree[idx] = prio ** self.alpha
             self.min_tree[idx] = prio ** self.alpha
             self.max_prio = max(self.max_prio, prio)
 
     def _sample_proportional(self):
-        idxs = []
-        p_total = self.sum_tree.sum(0, self.ptr - 1)
+        p_total = self.sum_tree.sum(0, self.size)
         segment = p_total / self.batch_size
-        for i in range(self.batch_size):
-            a = segment * i
-            b = segment * (i + 1)
-            upperbound = random.uniform(a, b)
-            idx = self.sum_tree.retrieve(upperbound)
-            idxs.append(idx)
-            
+        upperbounds = segment * (np.arange(self.batch_size) + np.random.uniform(size=self.batch_size))
+        idxs = np.minimum(self.sum_tree.retrieve_batch(upperbounds), self.size - 1)
+
         return idxs
     
     def _calculate_weight(self, idx, beta):
         p_min = self.min_tree.min() / self.sum_tree.sum()
-        max_weight = (p_min * self.ptr) ** (-beta)
+        max_weight = (p_min * self.size) ** (-beta)
         
         p_sample = self.sum_tree[idx] / self.sum_tree.sum()
-        weight = (p_sample * self.ptr) ** (-beta)
+        weight = (p_sample * self.size) ** (-beta)
         weight = weight / max_weight
         
         return weight
@@ -394,6 +419,7 @@ class SharedPrioritizedReplayBuffer(object):
         self.ptr, self.is_full = 0, False
 
     def update_priorities(self, idxs, prios):
+        prios = np.maximum(prios, MIN_PRIO)
         for idx, prio in zip(idxs, prios):
             self.sum_tree[idx] = prio ** self.alpha
             self.min_tree[idx] = prio ** self.alpha
@@ -419,24 +445,19 @@ class SharedPrioritizedReplayBuffer(object):
         return normalized_elements
     
     def _sample_proportional(self):
-        idxs = []
-        p_total = self.sum_tree.sum(0, self.ptr - 1)
+        p_total = self.sum_tree.sum(0, self.size())
         segment = p_total / self.batch_size
-        for i in range(self.batch_size):
-            a = segment * i
-            b = segment * (i + 1)
-            upperbound = random.uniform(a, b)
-            idx = self.sum_tree.retrieve(upperbound)
-            idxs.append(idx)
-            
+        upperbounds = segment * (np.arange(self.batch_size) + np.random.uniform(size=self.batch_size))
+        idxs = np.minimum(self.sum_tree.retrieve_batch(upperbounds), self.size() - 1)
+
         return idxs
     
     def _calculate_weight(self, idx, beta):
         p_min = self.min_tree.min() / self.sum_tree.sum()
-        max_weight = (p_min * self.ptr) ** (-beta)
+        max_weight = (p_min * self.size()) ** (-beta)
         
         p_sample = self.sum_tree[idx] / self.sum_tree.sum()
-        weight = (p_sample * self.ptr) ** (-beta)
+        weight = (p_sample * self.size()) ** (-beta)
         weight = weight / max_weight
         
         return weight
\ No newline at end of file
@@ -0,0 +1,47 @@
+import json
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+
+def save_checkpoint(save_path, **state_dicts):
+    tensors, metadata = {}, {}
+    for name, state_dict in state_dicts.items():
+        if 'param_groups' in state_dict:
+            for idx, state in state_dict['state'].items():
+                for key, value in state.items():
+                    tensors[f'{name}.state.{idx}.{key}'] = torch.as_tensor(value).contiguous()
+            metadata[f'{name}.param_groups'] = json.dumps(state_dict['param_groups'])
+        else:
+            for key, value in state_dict.items():
+                tensors[f'{name}.{key}'] = value.contiguous()
+    save_file(tensors, save_path, metadata=metadata)
+
+
+# a safetensors file opens with an 8-byte header length followed by its JSON header
+def _is_safetensors(load_path):
+    with open(load_path, 'rb') as f:
+        header = f.read(9)
+    return len(header) == 9 and header[8:] == b'{'
+
+
+def load_checkpoint(load_path, device='cpu'):
+    # checkpoints written with torch.save before the safetensors format
+    if not _is_safetensors(load_path):
+        return torch.load(load_path, map_location=device, weights_only=True)
+
+    state_dicts = {}
+    with safe_open(load_path, framework='pt', device=str(device)) as f:
+        metadata = f.metadata() or {}
+        for full_key in f.keys():
+            name, key = full_key.split('.', 1)
+            state_dicts.setdefault(name, {})[key] = f.get_tensor(full_key)
+
+    for meta_key, param_groups in metadata.items():
+        name = meta_key[:-len('.param_groups')]
+        state = {}
+        for key, value in state_dicts.pop(name, {}).items():
+            _, idx, field = key.split('.', 2)
+            state.setdefault(int(idx), {})[field] = value.cpu() if field == 'step' else value
+        state_dicts[name] = {'state': state, 'param_groups': json.loads(param_groups)}
+    return state_dicts
@@ -196,12 +196,15 @@ class MLPGaussianPolicy(MLPBase):
 
     def log_prob(self, state, action):
         dist = self.dist(state)
-        x = self.bijector.inverse(action)
-        return dist.log_prob(x).sum(dim=-1, keepdims=True)
+        return self.dist_log_prob(dist, action)
 
     def entropy(self, state):
         dist = self.dist(state)
         return dist.entropy().mean()
+
+    def dist_log_prob(self, dist, action):
+        x = self.bijector.inverse(action)
+        return dist.log_prob(x).sum(dim=-1, keepdims=True)
     
     def sample(self, state):
         dist = self.dist(state)
@@ -239,12 +242,15 @@ class MLPGaussianSDEPolicy(MLPBase):
 
     def log_prob(self, state, action):
         dist = self.dist(state)
-        x = self.bijector.inverse(action)
-        return dist.log_prob(x).sum(dim=-1, keepdims=True)
+        return self.dist_log_prob(dist, action)
 
     def entropy(self, state):
         dist = self.dist(state)
         return dist.entropy().mean()
+
+    def dist_log_prob(self, dist, action):
+        x = self.bijector.inverse(action)
+        return dist.log_prob(x).sum(dim=-1, keepdims=True)
     
     def sample(self, state):
         dist = self.dist(state)
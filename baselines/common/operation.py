@@ -1,6 +1,7 @@
-import torch
-import operator
-from typing import Callable
+import math
+import torch, torch.nn.functional as F
+import numpy as np
+from numba import njit, prange
 
 
 # https://github.com/Stable-Baselines-Team/stable-baselines3-contrib/blob/master/sb3_contrib/common/utils.py
@@ -13,8 +14,12 @@ def quantile_huber_loss(current_quantiles, target_quantiles, weights=None, sum_o
         tau = tau.view(1, 1, -1, 1)
 
     pairwise_delta = target_quantiles.unsqueeze(-2) - current_quantiles.unsqueeze(-1)
-    abs_pairwise_delta = torch.abs(pairwise_delta)
-    huber_loss = torch.where(abs_pairwise_delta > 1, abs_pairwise_delta - 0.5, pairwise_delta ** 2 * 0.5)
+    huber_loss = F.smooth_l1_loss(
+        current_quantiles.unsqueeze(-1).expand_as(pairwise_delta),
+        target_quantiles.unsqueeze(-2).expand_as(pairwise_delta),
+        reduction='none',
+        beta=1.0,
+        )
     loss = torch.abs(tau - (pairwise_delta.detach() < 0).float()) * huber_loss
     if weights is not None:
         loss = (weights.view(-1, 1, 1) * loss).sum(dim=-2).mean() if sum_over_quantiles else (weights.view(-1, 1, 1, 1) * loss).mean()
@@ -23,6 +28,23 @@ def quantile_huber_loss(current_quantiles, target_quantiles, weights=None, sum_o
     return loss, pairwise_delta.sum(dim=1).mean(dim=1, keepdim=True)
 
 
+@njit(cache=True, fastmath=True)
+def gae_numba(rewards, values, next_values, dones, gamma, lmda, rets, advs, stride=1):
+    # time-major rollouts of `stride` envs: the successor of row i is row i + stride
+    n = rewards.shape[0]
+    for i in range(n):
+        rets[i] = rewards[i]
+        advs[i] = rewards[i] + (1. - dones[i]) * gamma * next_values[i] - values[i]
+    for i in range(n - stride - 1, -1, -1):
+        rets[i] += (1. - dones[i]) * gamma * rets[i + stride]
+        advs[i] += (1. - dones[i]) * gamma * lmda * advs[i + stride]
+
+
+@torch.jit.script
+def _tanh_log_prob_correction(x: torch.Tensor) -> torch.Tensor:
+    return 2.0 * (math.log(2.0) - x - F.softplus(-2.0 * x))
+
+
 # https://github.com/DLR-RM/stable-baselines3/blob/master/stable_baselines3/common/distributions.py#L620
 class TanhBijector:
     def __init__(self, epsilon: float = 1e-7):
@@ -43,46 +65,83 @@ class TanhBijector:
         return TanhBijector.atanh(y.clamp(min=-1.0 + eps, max=1.0 - eps))
 
     def log_prob_correction(self, x: torch.Tensor) -> torch.Tensor:
-        return torch.log(1.0 - torch.tanh(x) ** 2 + self.epsilon)
+        return _tanh_log_prob_correction(x)
+
+
+@njit(cache=True)
+def _retrieve(tree: np.ndarray, capacity: int, upperbound: float) -> int:
+    idx = 1
+    while idx < capacity:
+        left = 2 * idx
+        if tree[left] > upperbound:
+            idx = left
+        else:
+            upperbound -= tree[left]
+            idx = left + 1
+    return idx - capacity
+
+
+@njit(cache=True, parallel=True)
+def _retrieve_batch(tree: np.ndarray, capacity: int, upperbounds: np.ndarray) -> np.ndarray:
+    idxs = np.empty(upperbounds.shape[0], dtype=np.int64)
+    for i in prange(upperbounds.shape[0]):
+        idxs[i] = _retrieve(tree, capacity, upperbounds[i])
+    return idxs
+
+
+@njit(cache=True)
+def _sum_update(tree: np.ndarray, idx: int, val: float):
+    tree[idx] = val
+    idx //= 2
+    while idx >= 1:
+        tree[idx] = tree[2 * idx] + tree[2 * idx + 1]
+        idx //= 2
+
+
+@njit(cache=True)
+def _min_update(tree: np.ndarray, idx: int, val: float):
+    tree[idx] = val
+    idx //= 2
+    while idx >= 1:
+        left, right = tree[2 * idx], tree[2 * idx + 1]
+        tree[idx] = left if left < right else right
+        idx //= 2
 
 
 # https://github.com/openai/baselines/blob/master/baselines/common/segment_tree.py
 class SegmentTree:
-    def __init__(self, capacity: int, operation: Callable, init_value: float):
+    def __init__(self, capacity: int, init_value: float):
         self.capacity = capacity
-        self.tree = [init_value for _ in range(2 * capacity)]
-        self.operation = operation
-
-    def _operate_helper(self, start: int, end: int, node: int, node_start: int, node_end: int) -> float:
-        if start == node_start and end == node_end:
-            return self.tree[node]
-        mid = (node_start + node_end) // 2
-        if end <= mid:
-            return self._operate_helper(start, end, 2 * node, node_start, mid)
-        else:
-            if mid + 1 <= start:
-                return self._operate_helper(start, end, 2 * node + 1, mid + 1, node_end)
-            else:
-                return self.operation(
-                    self._operate_helper(start, mid, 2 * node, node_start, mid),
-                    self._operate_helper(mid + 1, end, 2 * node + 1, mid + 1, node_end),
-                )
+        self.tree = np.full(2 * capacity, init_value, dtype=np.float32)
+        self.init_value = init_value
+
+    def _combine(self, a: float, b: float) -> float:
+        raise NotImplementedError()
 
     def operate(self, start: int = 0, end: int = 0) -> float:
         if end <= 0:
             end += self.capacity
         end -= 1
-
-        return self._operate_helper(start, end, 1, 0, self.capacity - 1)
-
+        if start == 0 and end == self.capacity - 1:
+            return float(self.tree[1])
+
+        result = self.init_value
+        start += self.capacity
+        end += self.capacity + 1
+        while start < end:
+            if start & 1:
+                result = self._combine(result, self.tree[start])
+                start += 1
+            if end & 1:
+                end -= 1
+                result = self._combine(result, self.tree[end])
+            start //= 2
+            end //= 2
+        return float(result)
+
+    # _combine serves operate(); the per-item update walk is compiled per subclass (_sum_update, _min_update)
     def __setitem__(self, idx: int, val: float):
-        idx += self.capacity
-        self.tree[idx] = val
-
-        idx //= 2
-        while idx >= 1:
-            self.tree[idx] = self.operation(self.tree[2 * idx], self.tree[2 * idx + 1])
-            idx //= 2
+        raise NotImplementedError()
 
     def __getitem__(self, idx: int) -> float:
         return self.tree[self.capacity + idx]
@@ -91,28 +150,34 @@ class SegmentTree:
 # https://github.com/openai/baselines/blob/master/baselines/common/segment_tree.py
 class SumSegmentTree(SegmentTree):
     def __init__(self, capacity: int):
-        super(SumSegmentTree, self).__init__(capacity=capacity, operation=operator.add, init_value=0.0)
+        super(SumSegmentTree, self).__init__(capacity=capacity, init_value=0.0)
+
+    def _combine(self, a: float, b: float) -> float:
+        return a + b
+
+    def __setitem__(self, idx: int, val: float):
+        _sum_update(self.tree, self.capacity + idx, val)
 
     def sum(self, start: int = 0, end: int = 0) -> float:
         return super(SumSegmentTree, self).operate(start, end)
 
     def retrieve(self, upperbound: float) -> int:
-        idx = 1
-        while idx < self.capacity:
-            left = 2 * idx
-            right = left + 1
-            if self.tree[left] > upperbound:
-                idx = 2 * idx
-            else:
-                upperbound -= self.tree[left]
-                idx = right
-        return idx - self.capacity
+        return int(_retrieve(self.tree, self.capacity, upperbound))
+
+    def retrieve_batch(self, upperbounds: np.ndarray) -> np.ndarray:
+        return _retrieve_batch(self.tree, self.capacity, np.asarray(upperbounds, dtype=np.float64))
 
 
 # https://github.com/openai/baselines/blob/master/baselines/common/segment_tree.py
 class MinSegmentTree(SegmentTree):
     def __init__(self, capacity: int):
-        super(MinSegmentTree, self).__init__(capacity=capacity, operation=min, init_value=float("inf"))
+        super(MinSegmentTree, self).__init__(capacity=capacity, init_value=float("inf"))
+
+    def _combine(self, a: float, b: float) -> float:
+        return a if a < b else b
+
+    def __setitem__(self, idx: int, val: float):
+        _min_update(self.tree, self.capacity + idx, val)
 
     def min(self, start: int = 0, end: int = 0) -> float:
         return super(MinSegmentTree, self).operate(start, end)
\ No newline at end of file
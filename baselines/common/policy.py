@@ -2,8 +2,9 @@ import gym
 import torch
 import numpy as np
 from copy import deepcopy
+from baselines.common.operation import gae_numba
 from baselines.common.buffer import RolloutBuffer, ReplayBuffer, PrioritizedReplayBuffer
-from baselines.common.train import Trainer, DistributedTrainer
+from baselines.common.train import Trainer, AsyncVectorTrainer, DistributedTrainer
 
 
 class OnPolicyAlgorithm:
@@ -28,6 +29,7 @@ class OnPolicyAlgorithm:
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.timesteps = 0
         self.epsilon = 1e-8
+        self.n_envs = 1
         
         self.actor_size = actor_size
         self.critic_size = critic_size
@@ -60,11 +62,13 @@ class OnPolicyAlgorithm:
         raise NotImplementedError()
     
     def GAE(self, values, next_values, rewards, dones):
-        delta = rewards + (1. - dones) * self.gamma * next_values - values
-        rets, advs = torch.clone(rewards), torch.clone(delta)
-        for i in reversed(range(len(rets) - 1)):
-            rets[i] += (1. - dones[i]) * self.gamma * rets[i + 1]
-            advs[i] += (1. - dones[i]) * self.gamma * self.lmda * advs[i + 1]
+        values, next_values, np_rewards, dones = (
+            x.detach().float().cpu().numpy().reshape(-1) for x in (values, next_values, rewards, dones)
+            )
+        rets, advs = np.empty_like(np_rewards), np.empty_like(np_rewards)
+        gae_numba(np_rewards, values, next_values, dones, self.gamma, self.lmda, rets, advs, self.n_envs)
+        rets = torch.from_numpy(rets).view_as(rewards).to(rewards.device)
+        advs = torch.from_numpy(advs).view_as(rewards).to(rewards.device)
         
         if self.adv_norm:
             advs = (advs - advs.mean()) / (advs.std() + self.epsilon)
@@ -89,6 +93,9 @@ class OnPolicyAlgorithm:
         self.policy_type = 'on_policy'
         self.show_stats = config.get('show_stats', True)
         self.show_graphs = config.get('show_graphs', True)
+
+        if self.n_runners > 1 and self.n_envs > 1:
+            raise ValueError('n_envs > 1 is not supported together with n_runners > 1.')
     
         if self.n_runners > 1:
             self.trainer = DistributedTrainer(
@@ -114,12 +121,23 @@ class OnPolicyAlgorithm:
                 show_graphs=self.show_graphs,
                 )
         else:
-            self.trainer = Trainer(
-                env=self.env, 
-                eval_env=self.eval_env, 
-                agent=self, 
-                seed=self.seed, 
-                )
+            if self.n_envs > 1:
+                self.trainer = AsyncVectorTrainer(
+                    env=self.env, 
+                    eval_env=self.eval_env, 
+                    agent=self, 
+                    seed=self.seed, 
+                    n_envs=self.n_envs,
+                    env_fn=config.get('env_fn', None),
+                    overlap_update=config.get('overlap_update', False),
+                    )
+            else:
+                self.trainer = Trainer(
+                    env=self.env, 
+                    eval_env=self.eval_env, 
+                    agent=self, 
+                    seed=self.seed, 
+                    )
             
             self.trainer.train(
                 project_name=self.project_name, 
@@ -3,6 +3,7 @@ import torch, numpy as np
 import ray, ray.exceptions
 from tqdm import tqdm
 from copy import deepcopy
+from functools import partial
 from baselines.common.wrapper import NormalizedEnv
 from baselines.common.plot import plot_train_result, plot_epoch_result
 from baselines.common.buffer import SharedRolloutBuffer, SharedReplayBuffer, SharedPrioritizedReplayBuffer
@@ -18,17 +19,32 @@ def seed_all(seed):
     torch.backends.cudnn.deterministic = True
 
 
+def scale_action(action_space, action):
+    if isinstance(action_space, gym.spaces.Box):
+        max_action = action_space.high
+        min_action = action_space.low
+        return 0.5 * (action + 1) * (max_action - min_action) + min_action
+    return action
+
+
 def get_next_step(env, action):
-    if isinstance(env.action_space, gym.spaces.Box):
-        max_action = env.action_space.high
-        min_action = env.action_space.low
-        x = 0.5 * (action + 1) * (max_action - min_action) + min_action
-        next_state, reward, terminated, info = env.step(x)
-    else:
-        next_state, reward, terminated, info = env.step(action)
+    next_state, reward, terminated, info = env.step(scale_action(env.action_space, action))
     return next_state, reward, terminated, info
 
 
+def make_env(env_fn, normalized_env, gamma, epsilon):
+    env = env_fn()
+    if normalized_env:
+        env = NormalizedEnv(
+            env=env, 
+            obs_norm=True, 
+            ret_norm=False,
+            gamma=gamma, 
+            epsilon=epsilon
+            ) 
+    return env
+
+
 def evaluate(env, agent, seed, eval_iters, normalized_env=False):
     if normalized_env:
         env = NormalizedEnv(
@@ -142,89 +158,15 @@ class Trainer:
             else:
                 print(f"BUFFER HAS BEEN FAILED TO BE LOADED.")
 
-        if normalized_env:
-            self.train_env = NormalizedEnv(
-                env=self.train_env, 
-                obs_norm=True, 
-                ret_norm=False,
-                gamma=self.agent.gamma, 
-                epsilon=self.agent.epsilon
-                ) 
-
-        global_stats = {
+        self.global_stats = {
             'max_ret': -np.inf,
             'max_len': 0,
             'mean_ret': 0,
             'mean_len': 0,
             'ep_count': 0,
         }
-
-        total_ep_ret, total_ep_len = [], []
-        num_eps, ep_ret, ep_len = 0, 0, 0
-        state, terminated = self.train_env.reset(seed=self.seed), False
-
-        for timesteps in tqdm(range(self.max_iters), desc=f'TRAINNIG'):
-            action = self.agent.act(state)
-            next_state, reward, terminated, _ = get_next_step(self.train_env, action)
-            result = self.agent.step(state, action, reward, next_state, terminated)
-
-            ep_ret += reward
-            ep_len += 1
-            state = next_state
-
-            if result is not None:
-                self.epoch_logger.append({'timesteps': timesteps, 'result': result})
-
-            if terminated:
-                num_eps += 1
-                state, terminated = self.train_env.reset(), False
-
-                total_ep_ret.append(ep_ret)
-                total_ep_len.append(ep_len)
-                ep_ret, ep_len = 0, 0
-
-            if timesteps % self.eval_intervals == 0:
-                if self.eval_mode == True:
-                    total_ep_ret, total_ep_len = evaluate(
-                        self.eval_env, self.agent, self.seed, self.eval_iters, self.normalized_env)
-                
-                if total_ep_ret != [] and total_ep_len != []:
-                    max_ep_ret = np.max(total_ep_ret)
-                    max_ep_len = np.max(total_ep_len)
-                    mean_ep_ret = np.mean(total_ep_ret)
-                    mean_ep_len = np.mean(total_ep_len) 
-
-                    self.epoch_logger.append({
-                        'timesteps': timesteps,
-                        'number_of_eps': num_eps,
-                        'max_ep_ret': max_ep_ret,
-                        'max_ep_len': max_ep_len,
-                        'mean_ep_ret': mean_ep_ret,
-                        'mean_ep_len': mean_ep_len,
-                    })
-
-                    global_stats['max_ret'] = max(global_stats['max_ret'], max_ep_ret)
-                    global_stats['max_len'] = max(global_stats['max_len'], max_ep_len)
-                    global_stats['mean_ret'] += mean_ep_ret
-                    global_stats['mean_len'] += mean_ep_len
-                    global_stats['ep_count'] += num_eps
-
-                    if self.show_stats:
-                        print(f'----------------------------+-------------------------------------')
-                        print(f'TIMESTEPS                   | {timesteps}')   
-                        print(f'THE NUMBER OF EPISODES      | {num_eps}')
-                        print(f'MAX EPISODE LENGTH          | {max_ep_len}')
-                        print(f'MAX EPISODE RETURN          | {round(max_ep_ret, 4)}')
-                        print(f'MEAN EPISODE LENGTH         | {round(mean_ep_len, 4)}')
-                        print(f'MEAN EPISODE RETURN         | {round(mean_ep_ret, 4)}')            
-                        print(f'----------------------------+-------------------------------------')
-                
-                self.agent.save(model_path)
-                self.agent.buffer.save(buffer_path)
-                self.save_logs()
-
-                num_eps = 0
-                total_ep_ret, total_ep_len = [], []
+        self.rollout(model_path, buffer_path)
+        global_stats = self.global_stats
 
         self.train_env.close()
         self.eval_env.close()
@@ -268,6 +210,85 @@ class Trainer:
         plot_train_result(project_name, self.epoch_logger, window=20, show_graphs=self.show_graphs)
         plot_epoch_result(project_name, self.epoch_logger, window=20, show_graphs=self.show_graphs)
 
+    def rollout(self, model_path, buffer_path):
+        if self.normalized_env:
+            self.train_env = NormalizedEnv(
+                env=self.train_env, 
+                obs_norm=True, 
+                ret_norm=False,
+                gamma=self.agent.gamma, 
+                epsilon=self.agent.epsilon
+                ) 
+
+        total_ep_ret, total_ep_len = [], []
+        num_eps, ep_ret, ep_len = 0, 0, 0
+        state, terminated = self.train_env.reset(seed=self.seed), False
+
+        for timesteps in tqdm(range(self.max_iters), desc=f'TRAINNIG'):
+            action = self.agent.act(state)
+            next_state, reward, terminated, _ = get_next_step(self.train_env, action)
+            result = self.agent.step(state, action, reward, next_state, terminated)
+
+            ep_ret += reward
+            ep_len += 1
+            state = next_state
+
+            if result is not None:
+                self.epoch_logger.append({'timesteps': timesteps, 'result': result})
+
+            if terminated:
+                num_eps += 1
+                state, terminated = self.train_env.reset(), False
+
+                total_ep_ret.append(ep_ret)
+                total_ep_len.append(ep_len)
+                ep_ret, ep_len = 0, 0
+
+            if timesteps % self.eval_intervals == 0:
+                self.log_epoch(timesteps, num_eps, total_ep_ret, total_ep_len, model_path, buffer_path)
+                num_eps = 0
+                total_ep_ret, total_ep_len = [], []
+
+    def log_epoch(self, timesteps, num_eps, total_ep_ret, total_ep_len, model_path, buffer_path):
+        if self.eval_mode == True:
+            total_ep_ret, total_ep_len = evaluate(
+                self.eval_env, self.agent, self.seed, self.eval_iters, self.normalized_env)
+        
+        if total_ep_ret != [] and total_ep_len != []:
+            max_ep_ret = np.max(total_ep_ret)
+            max_ep_len = np.max(total_ep_len)
+            mean_ep_ret = np.mean(total_ep_ret)
+            mean_ep_len = np.mean(total_ep_len) 
+
+            self.epoch_logger.append({
+                'timesteps': timesteps,
+                'number_of_eps': num_eps,
+                'max_ep_ret': max_ep_ret,
+                'max_ep_len': max_ep_len,
+                'mean_ep_ret': mean_ep_ret,
+                'mean_ep_len': mean_ep_len,
+            })
+
+            self.global_stats['max_ret'] = max(self.global_stats['max_ret'], max_ep_ret)
+            self.global_stats['max_len'] = max(self.global_stats['max_len'], max_ep_len)
+            self.global_stats['mean_ret'] += mean_ep_ret
+            self.global_stats['mean_len'] += mean_ep_len
+            self.global_stats['ep_count'] += num_eps
+
+            if self.show_stats:
+                print(f'----------------------------+-------------------------------------')
+                print(f'TIMESTEPS                   | {timesteps}')   
+                print(f'THE NUMBER OF EPISODES      | {num_eps}')
+                print(f'MAX EPISODE LENGTH          | {max_ep_len}')
+                print(f'MAX EPISODE RETURN          | {round(max_ep_ret, 4)}')
+                print(f'MEAN EPISODE LENGTH         | {round(mean_ep_len, 4)}')
+                print(f'MEAN EPISODE RETURN         | {round(mean_ep_ret, 4)}')            
+                print(f'----------------------------+-------------------------------------')
+                
+        self.agent.save(model_path)
+        self.agent.buffer.save(buffer_path)
+        self.save_logs()
+
     def get_logs(self):
         return self.train_logger, self.epoch_logger
     
@@ -280,6 +301,77 @@ class Trainer:
             pickle.dump(data, f)
 
 
+class AsyncVectorTrainer(Trainer):
+    # Each worker builds its own env from env_fn (gym.make(env.spec.id, **env.spec.kwargs) by default),
+    # so wrappers applied to the passed env are not inherited and have to be part of env_fn. With
+    # normalized_env, every worker keeps its own observation statistics.
+    # With overlap_update, learn() runs while the workers step, at the cost of one stale vector step.
+    def __init__(self, env, eval_env, agent, seed, n_envs, env_fn=None, overlap_update=False):
+        super().__init__(env=env, eval_env=eval_env, agent=agent, seed=seed)
+        self.n_envs = n_envs
+        self.overlap_update = overlap_update
+        if env_fn is None:
+            if env.spec is None:
+                raise ValueError('env has no spec to rebuild it from; pass env_fn to train() when n_envs > 1.')
+            env_fn = partial(gym.make, env.spec.id, **env.spec.kwargs)
+        self.env_fn = env_fn
+
+    def rollout(self, model_path, buffer_path):
+        env_fn = partial(make_env, self.env_fn, self.normalized_env, self.agent.gamma, self.agent.epsilon)
+        # kept local: the trainer is pickled with the agent in save_logs(), and AsyncVectorEnv is not picklable
+        vector_env = gym.vector.AsyncVectorEnv([env_fn for _ in range(self.n_envs)])
+        action_space = vector_env.single_action_space
+
+        total_ep_ret, total_ep_len = [], []
+        num_eps = 0
+        ep_ret, ep_len = np.zeros(self.n_envs), np.zeros(self.n_envs, dtype=int)
+        transitions = []
+        states = vector_env.reset(seed=self.seed)
+
+        for timesteps in tqdm(range(0, self.max_iters, self.n_envs), desc=f'TRAINNIG'):
+            # a vector step that completes the rollout is stored before act(), so learn() runs first
+            # and the next rollout is sampled entirely by the updated policy; with overlap_update it
+            # is stored below instead, and its first vector step comes from the pre-update policy
+            completes_rollout = self.agent.buffer.size + len(transitions) >= self.agent.update_after
+            if completes_rollout and not self.overlap_update:
+                self.store(timesteps, transitions)
+                transitions = []
+
+            actions = self.agent.act(states)
+            vector_env.step_async(scale_action(action_space, actions))
+
+            # any other vector step (and any learn() it triggers) runs while the workers step, one whole
+            # step at a time so the buffer stays time-major: row t * n_envs + i is env i at step t
+            self.store(timesteps, transitions)
+
+            next_states, rewards, terminateds, _ = vector_env.step_wait()
+            transitions = list(zip(states, actions, rewards, next_states, terminateds))
+
+            ep_ret += rewards
+            ep_len += 1
+            states = next_states
+
+            for i in np.flatnonzero(terminateds):
+                num_eps += 1
+                total_ep_ret.append(ep_ret[i])
+                total_ep_len.append(ep_len[i])
+                ep_ret[i], ep_len[i] = 0, 0
+
+            if timesteps % self.eval_intervals < self.n_envs:
+                self.log_epoch(timesteps, num_eps, total_ep_ret, total_ep_len, model_path, buffer_path)
+                num_eps = 0
+                total_ep_ret, total_ep_len = [], []
+
+        self.store(timesteps, transitions)
+        vector_env.close()
+
+    def store(self, timesteps, transitions):
+        for transition in transitions:
+            result = self.agent.step(*transition)
+            if result is not None:
+                self.epoch_logger.append({'timesteps': timesteps, 'result': result})
+
+
 
 
 